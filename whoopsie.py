@@ -1,26 +1,34 @@
 import datetime
+import functools
 import re
 import sqlite3
 import tomllib
 from pathlib import Path
-from textwrap import dedent
-from typing import Self
+from typing import Iterable, Iterator, Self
 
 import attr
-import bs4
 import dateutil.tz
+import lxml.etree
+import lxml.html
 import mastodon
 import requests
 import typer
 
 
-@attr.frozen()
+@attr.frozen(slots=True)
 class PendingToot:
     event_id: str
     content: str
 
 
-@attr.define()
+@attr.frozen(slots=True)
+class Visit:
+    visited: datetime.datetime
+    etag: str | None
+    last_modified: str | None
+
+
+@attr.define(slots=True)
 class EventInfo:
     event_date: str | None
     facility: str | None
@@ -45,13 +53,9 @@ class EventInfo:
 
     def format(self):
         return (
-            dedent(
-                f"""\
-            {self.headline}
-            {self.location}, {self.event_date or 'Date unknown'}
-        """
-            )
-            + self.content
+            f"{self.headline}\n"
+            f"{self.location}, {self.event_date or 'Date unknown'}\n"
+            f"{self.content}"
         )
 
 
@@ -65,36 +69,76 @@ CREATE TABLE IF NOT EXISTS toots (
 
 CREATE TABLE IF NOT EXISTS urls (
     url TEXT NOT NULL UNIQUE,
-    visited TIMESTAMP DEFAULT CURRENT_TIMESTAMP NOT NULL
+    visited TIMESTAMP DEFAULT CURRENT_TIMESTAMP NOT NULL,
+    etag TEXT,
+    last_modified TEXT
 );
+
+CREATE INDEX IF NOT EXISTS toots_pending_ts ON toots(timestamp) WHERE pending;
 """
 
 
-@attr.define()
+@attr.define(slots=True)
 class BotStore:
     connection: sqlite3.Connection
 
     def __attrs_post_init__(self):
         with self.connection:
             self.connection.executescript(schema)
+            url_columns = {
+                row[1] for row in self.connection.execute("PRAGMA table_info(urls)")
+            }
+            for column in ("etag", "last_modified"):
+                if column not in url_columns:
+                    self.connection.execute(
+                        f"ALTER TABLE urls ADD COLUMN {column} TEXT"
+                    )
 
     @classmethod
     def from_path(cls, path) -> Self:
+        name = str(path)
+        if name == ":memory:" or name.startswith("file:"):
+            return cls._connect(name)
+        name = str(Path(name).resolve())
+        store = cls._cached_connect(name)
+        if not store._is_open():
+            cls._cached_connect.cache_clear()
+            store = cls._cached_connect(name)
+        return store
+
+    @classmethod
+    @functools.lru_cache(maxsize=None)
+    def _cached_connect(cls, path: str) -> Self:
+        return cls._connect(path)
+
+    @classmethod
+    def _connect(cls, path: str) -> Self:
         conn = sqlite3.connect(path)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=5000")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA cache_size=-20000")
         return cls(conn)
 
+    def _is_open(self) -> bool:
+        try:
+            self.connection.execute("SELECT 1")
+        except sqlite3.ProgrammingError:
+            return False
+        return True
+
     def next_toot(self) -> PendingToot | None:
-        with self.connection:
-            cursor = self.connection.execute(
-                """\
-                SELECT event_id, content
-                FROM toots
-                WHERE pending
-                ORDER BY timestamp ASC
-                LIMIT 1
-            """
-            )
-            row = cursor.fetchone()
+        cursor = self.connection.execute(
+            """\
+            SELECT event_id, content
+            FROM toots
+            WHERE pending
+            ORDER BY timestamp ASC
+            LIMIT 1
+        """
+        )
+        row = cursor.fetchone()
         if not row:
             return None
         return PendingToot(
@@ -102,40 +146,56 @@ class BotStore:
             content=row[1],
         )
 
-    def last_visit(self, url: str) -> datetime.datetime | None:
-        with self.connection:
-            cursor = self.connection.execute(
-                """\
-                SELECT visited
-                FROM urls
-                WHERE url = ?
-            """,
-                (url,),
-            )
-            row = cursor.fetchone()
+    def last_visit(self, url: str) -> Visit | None:
+        cursor = self.connection.execute(
+            """\
+            SELECT visited, etag, last_modified
+            FROM urls
+            WHERE url = ?
+        """,
+            (url,),
+        )
+        row = cursor.fetchone()
         if not row:
             return None
-        return datetime.datetime.fromisoformat(row[0])
+        return Visit(
+            visited=datetime.datetime.fromisoformat(row[0]),
+            etag=row[1],
+            last_modified=row[2],
+        )
 
-    def record_visit(self, urls: list[str]) -> None:
-        with self.connection:
-            self.connection.executemany(
-                """\
-                INSERT OR REPLACE INTO urls
-                VALUES(:url, CURRENT_TIMESTAMP)""",
-                [dict(url=url) for url in urls],
-            )
+    def _insert_visit(
+        self, url: str, etag: str | None = None, last_modified: str | None = None
+    ) -> None:
+        self.connection.execute(
+            """\
+            INSERT OR REPLACE INTO urls
+            (url, visited, etag, last_modified)
+            VALUES(?, CURRENT_TIMESTAMP, ?, ?)""",
+            (url, etag, last_modified),
+        )
+
+    def _insert_toots(self, toots: list[PendingToot]) -> None:
+        self.connection.executemany(
+            """\
+            INSERT OR IGNORE INTO toots
+            (event_id, content, pending)
+            VALUES(?, ?, TRUE)
+            """,
+            [(toot.event_id, toot.content) for toot in toots],
+        )
 
-    def save_toots(self, toots: list[PendingToot]):
+    def save_page(
+        self,
+        toots: list[PendingToot],
+        url: str,
+        etag: str | None = None,
+        last_modified: str | None = None,
+    ):
+        """Save the toots scraped from url and mark it visited in one transaction."""
         with self.connection:
-            self.connection.executemany(
-                """\
-                INSERT OR IGNORE INTO toots
-                (event_id, content, pending)
-                VALUES(:event_id, :content, TRUE)
-                """,
-                [dict(event_id=toot.event_id, content=toot.content) for toot in toots],
-            )
+            self._insert_toots(toots)
+            self._insert_visit(url, etag, last_modified)
 
     def record_toot(self, toot: PendingToot):
         with self.connection:
@@ -149,28 +209,45 @@ class BotStore:
             )
 
 
-def extract(table: bs4.Tag) -> EventInfo:
+FIELDS_RE = re.compile(r"\b(Facility|City):([^\n]*?)(?=\s+\w+:|[ \t]*$)", re.MULTILINE)
+STATE_RE = re.compile(r"State: ([A-Z]{2})")
+DATE_RE = re.compile(r"Event Date: ([\d/]+)")
+
+
+def extract(table: lxml.html.HtmlElement) -> EventInfo:
     """Extract an EventInfo from an event div from the NRC website."""
-    facility = None
-    if m := re.search(r"Facility: (.*?)\s+\w+:", table.text, re.MULTILINE | re.DOTALL):
-        facility = m[1]
+    text = table.text_content()
+    fields: dict[str, str] = {}
+    for m in FIELDS_RE.finditer(text):
+        fields.setdefault(m[1], m[2].strip())
 
-    city = None
-    if m := re.search(r"City: (.*?)\s+\w+:", table.text, re.MULTILINE | re.DOTALL):
-        city = m[1]
+    facility = fields.get("Facility")
+    city = fields.get("City")
 
+    # State and Event Date are matched on their own: a free-text value can
+    # run into a following multi-word label such as "Event Date:".
     state = None
-    if m := re.search("State: ([A-Z]{2})", table.text):
+    if m := STATE_RE.search(text):
         state = m[1]
 
     event_date = None
-    if m := re.search(r"Event Date: ([\d/]+)", table.text, re.MULTILINE | re.DOTALL):
+    if m := DATE_RE.search(text):
         event_date = m[1]
 
-    event_text = table.find_next(string="Event Text").find_next("div").text.strip()  # type: ignore
+    event_div = table.xpath('.//*[text()="Event Text"]/following::div[1]')[0]
+    event_text = event_div.text_content().strip()
     headline, summary = event_text.split("\r\n", maxsplit=1)
     headline = headline.strip().split(" - ", maxsplit=1)[-1]
-    summary = re.split(r"via .*?:", summary, maxsplit=1)[-1].strip()
+    i = summary.find("via ")
+    while i != -1:
+        j = summary.find(":", i)
+        if j == -1:
+            break
+        if "\n" not in summary[i:j]:
+            summary = summary[j + 1 :]
+            break
+        i = summary.find("via ", i + 1)
+    summary = summary.strip()
 
     return EventInfo(
         event_date=event_date,
@@ -190,17 +267,34 @@ def format_toot(text: str, url: str, maxlen: int = 500) -> str:
     return "".join([text[:max_text_len].strip(), ellipsis, "\n", url])
 
 
-def page_as_toots(content: str, url: str) -> list[PendingToot]:
-    html = bs4.BeautifulSoup(content, features="html.parser")
-    events = html.find_all("div", id=re.compile(r"en\d+"))
-    toots = []
-    for e in events:
-        toots.append(
-            PendingToot(
-                event_id=e.attrs["id"],
-                content=format_toot(extract(e).format(), f"{url}#{e.attrs['id']}"),
-            )
+def read_toots(parser: lxml.etree.HTMLPullParser, url: str) -> Iterator[PendingToot]:
+    for _, e in parser.read_events():
+        event_id = e.get("id", "")
+        if not (event_id.startswith("en") and event_id[2:].isdecimal()):
+            continue
+        yield PendingToot(
+            event_id=event_id,
+            content=format_toot(extract(e).format(), f"{url}#{event_id}"),
         )
+        e.clear()
+
+
+def page_as_toots(
+    chunks: Iterable[bytes], url: str, encoding: str | None = None
+) -> list[PendingToot]:
+    parser = lxml.etree.HTMLPullParser(events=("end",), tag="div", encoding=encoding)
+    parser.set_element_class_lookup(lxml.html.HtmlElementClassLookup())
+    toots = []
+    pending = b""
+    for chunk in chunks:
+        # libxml2's push parser can miss a </script> end tag that is split
+        # across feeds, so only hand it data up to the last complete tag.
+        head, sep, pending = (pending + chunk).rpartition(b">")
+        parser.feed(head + sep)
+        toots.extend(read_toots(parser, url))
+    parser.feed(pending)
+    parser.close()
+    toots.extend(read_toots(parser, url))
     return toots
 
 
@@ -218,15 +312,30 @@ def scrape(database: Path, ymd: str = todays_date):
     store = BotStore.from_path(database)
     year = ymd[:4]
     url = f"https://www.nrc.gov/reading-rm/doc-collections/event-status/event/{year}/{ymd}en.html"
-    if store.last_visit(url):
-        return
-    response = requests.get(url)
-    if response.status_code != 200:
-        print(response.status_code)
-        return
-    toots = page_as_toots(response.text, url)
-    store.save_toots(toots)
-    store.record_visit([url])
+    headers = {}
+    if visit := store.last_visit(url):
+        # Without a validator from the server there is nothing to revalidate.
+        if not (visit.etag or visit.last_modified):
+            return
+        if visit.etag:
+            headers["If-None-Match"] = visit.etag
+        if visit.last_modified:
+            headers["If-Modified-Since"] = visit.last_modified
+    with requests.get(url, headers=headers, stream=True) as response:
+        if response.status_code == 304:
+            return
+        if response.status_code != 200:
+            print(response.status_code)
+            return
+        toots = page_as_toots(
+            response.iter_content(chunk_size=None), url, response.encoding
+        )
+    store.save_page(
+        toots,
+        url,
+        response.headers.get("ETag"),
+        response.headers.get("Last-Modified"),
+    )
 
 
 @app.command()